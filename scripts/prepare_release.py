@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import atexit
 import datetime
 import os
 import re
@@ -6,17 +7,32 @@ import subprocess
 import sys
 import xml.etree.ElementTree as ET
 
+# Patterns operate on raw bytes so files can be rewritten without a
+# decode/encode round-trip.
+_VERSION_RE = re.compile(rb'^version\s*=\s*"(\d+)\.(\d+)\.(\d+)"', re.MULTILINE)
+_VCODE_RE = re.compile(rb"^version_code\s*=\s*\d+", re.MULTILINE)
+# Matches the `tag:` (group 1) or `commit:` (group 2) field of the Flatpak manifest
+_MANIFEST_RE = re.compile(rb"(\s+tag:\s+)v[\d.]+|(\s+commit:\s+)[a-f0-9]{40}")
+# Metainfo <releases> start tag (or self-closing <releases/>) on its own line
+_RELEASES_RE = re.compile(r"^([ \t]*)<releases[ \t]*(/)?>[ \t]*$", re.MULTILINE)
+
+# git-cliff group ordering comments like <!-- 0 -->, and section header emojis
+_COMMENT_RE = re.compile(r"<!--\s*\d+\s*-->")
+_EMOJI_RE = re.compile(r"[🚀🐛🚜📚⚡🎨🧪⚙️◀️💼]")
+# Changelog items: *(scope)*, [**breaking**] and any leftover **
+_ITEM_RE = re.compile(
+    r"\*\(([^)]+)\)\*\s*|(\[?\*\*breaking\*\*\]?\s*)|\*\*", re.IGNORECASE
+)
+
 
 def main():
     cargo_path = "Cargo.toml"
 
     # 1. READ VERSION FROM CARGO.TOML
-    with open(cargo_path, "r") as f:
+    with open(cargo_path, "rb") as f:
         content = f.read()
 
-    ver_match = re.search(
-        r'^version\s*=\s*"(\d+)\.(\d+)\.(\d+)"', content, re.MULTILINE
-    )
+    ver_match = _VERSION_RE.search(content)
     if not ver_match:
         print("Error: Could not find version in Cargo.toml")
         sys.exit(1)
@@ -30,22 +46,31 @@ def main():
     print(f"🚀 Preparing release v{version_string} (Code: {version_code})")
 
     # 3. UPDATE VERSION_CODE IN CARGO.TOML
-    new_content = re.sub(
-        r"^version_code\s*=\s*\d+",
-        f"version_code = {version_code}",
-        content,
-        flags=re.MULTILINE,
-    )
+    new_content = _VCODE_RE.sub(f"version_code = {version_code}".encode(), content)
 
-    with open(cargo_path, "w") as f:
+    with open(cargo_path, "wb") as f:
         f.write(new_content)
     print(f"✅ Updated version_code to {version_code} in Cargo.toml")
 
+    # cargo generate-lockfile only depends on the updated Cargo.toml and is the
+    # slowest step, so it runs in the background while the other files are
+    # updated, and is waited for before staging.
+    print("🔒 Updating Cargo.lock...")
+    lockfile_proc = subprocess.Popen(["cargo", "generate-lockfile"])
+    # Don't exit while Cargo.lock is still being rewritten if a later step fails
+    atexit.register(lockfile_proc.wait)
+
     # 4. UPDATE MAIN CHANGELOG.MD
+    # git-cliff is only run once, for the unreleased section; the result is
+    # spliced into the existing CHANGELOG.md instead of regenerating it.
     print("📝 Updating CHANGELOG.md...")
-    subprocess.run(
-        ["git-cliff", "--tag", version_string, "--output", "CHANGELOG.md"], check=True
-    )
+    changelog_body = subprocess.run(
+        ["git-cliff", "--tag", version_string, "--unreleased", "--strip", "header"],
+        check=True,
+        stdout=subprocess.PIPE,
+        text=True,
+    ).stdout
+    _splice_changelog("CHANGELOG.md", version_string, changelog_body)
 
     # 5. GENERATE FASTLANE CHANGELOG
     fastlane_dir = "fastlane/metadata/android/en-US/changelogs"
@@ -53,11 +78,7 @@ def main():
     fastlane_file = os.path.join(fastlane_dir, f"{version_code}.txt")
 
     print(f"📝 Generating Fastlane changelog: {fastlane_file}")
-    changelog_body = subprocess.check_output(
-        ["git-cliff", "--tag", version_string, "--unreleased", "--strip", "header"],
-        text=True,
-    )
-    clean_body = re.sub(r"<!-- \d+ -->", "", changelog_body).strip()
+    clean_body = _COMMENT_RE.sub("", changelog_body).strip()
 
     with open(fastlane_file, "w") as f:
         f.write(clean_body)
@@ -68,22 +89,45 @@ def main():
 
     today = datetime.date.today().isoformat()
 
-    # Parse the changelog to create AppStream XML
-    changelog_xml = _parse_changelog_to_appstream(clean_body)
+    # Create the release element with its description
+    release = ET.Element("release", {"version": version_string, "date": today})
+    description = ET.SubElement(release, "description")
+    sections = _parse_changelog_to_appstream(clean_body)
+    for section_name, items in sections:
+        ET.SubElement(description, "p").text = f"{section_name}:"
+        ul = ET.SubElement(description, "ul")
+        for item in items:
+            ET.SubElement(ul, "li").text = item
+    if not sections:
+        # Fallback if parsing fails
+        ET.SubElement(description, "p").text = "See CHANGELOG.md for details."
+    ET.indent(release, space="  ", level=2)
 
-    # Create the release element with description
-    release_xml = f'    <release version="{version_string}" date="{today}">\n'
-    release_xml += f"      <description>\n{changelog_xml}      </description>\n"
-    release_xml += f"    </release>"
+    # Only the new subtree is serialized (ElementTree takes care of escaping);
+    # it is spliced into the raw text so the rest of the file is left as-is.
+    release_xml = "    " + ET.tostring(release, encoding="unicode")
 
     with open(metainfo_path, "r") as f:
         xml_content = f.read()
 
-    if "<releases>" in xml_content:
-        xml_content = xml_content.replace("<releases>", f"<releases>\n{release_xml}")
-    else:
+    match = _RELEASES_RE.search(xml_content)
+    if match is None:
         xml_content = xml_content.replace(
-            "</component>", f"  <releases>\n{release_xml}\n  </releases>\n</component>"
+            "</component>",
+            f"  <releases>\n{release_xml}\n  </releases>\n</component>",
+            1,
+        )
+    elif match.group(2):
+        # Expand an empty <releases/> into a start and end tag
+        indent = match.group(1)
+        xml_content = (
+            xml_content[: match.start()]
+            + f"{indent}<releases>\n{release_xml}\n{indent}</releases>"
+            + xml_content[match.end() :]
+        )
+    else:
+        xml_content = (
+            xml_content[: match.end()] + f"\n{release_xml}" + xml_content[match.end() :]
         )
 
     with open(metainfo_path, "w") as f:
@@ -105,25 +149,29 @@ def main():
             commit_hash = None
 
         if commit_hash:
-            with open(flatpak_manifest, "r") as f:
+            with open(flatpak_manifest, "rb") as f:
                 manifest_content = f.read()
 
-            # Update the tag field
-            manifest_content = re.sub(
-                r"(\s+tag:\s+)v[\d.]+", rf"\1v{version_string}", manifest_content
-            )
-
-            # Update the commit field
-            manifest_content = re.sub(
-                r"(\s+commit:\s+)[a-f0-9]{40}", rf"\g<1>{commit_hash}", manifest_content
+            # Update the tag and commit fields in a single pass
+            new_tag = f"v{version_string}".encode()
+            new_commit = commit_hash.encode()
+            manifest_content = _MANIFEST_RE.sub(
+                lambda m: (
+                    m.group(1) + new_tag
+                    if m.group(1) is not None
+                    else m.group(2) + new_commit
+                ),
+                manifest_content,
             )
 
-            with open(flatpak_manifest, "w") as f:
+            with open(flatpak_manifest, "wb") as f:
                 f.write(manifest_content)
 
-    # 8. Stage all files for git and update Cargo.lock
-    print("🔒 Updating Cargo.lock...")
-    subprocess.run(["cargo", "generate-lockfile"], check=True)
+    # 8. WAIT FOR CARGO.LOCK UPDATE
+    if lockfile_proc.wait() != 0:
+        raise subprocess.CalledProcessError(
+            lockfile_proc.returncode, lockfile_proc.args
+        )
 
     # 9. STAGE ALL FILES FOR GIT
     files_to_add = [
@@ -146,47 +194,83 @@ def main():
     )
 
 
-def _parse_changelog_to_appstream(changelog_md: str) -> str:
+def _splice_changelog(changelog_path: str, version_string: str, body: str) -> None:
+    """
+    Insert the release section generated by git-cliff at the top of the
+    existing changelog, below its header.
+
+    If a section for the same version is already present (e.g. the script is
+    re-run), it is replaced rather than duplicated.
+    """
+    body = body.strip()
+    if not body:
+        # Nothing unreleased; leave the changelog untouched
+        return
+
+    # Fallback for a missing file; keep in sync with [changelog].header in cliff.toml
+    header = "# Changelog\n\n"
+    try:
+        with open(changelog_path, "r") as f:
+            existing = f.read()
+    except FileNotFoundError:
+        existing = header
+
+    # Everything before the first release heading is the header (possibly empty)
+    if existing.startswith("## ["):
+        head, releases = "", existing
+    elif (first_release := existing.find("\n## [")) != -1:
+        head, releases = existing[: first_release + 1], existing[first_release + 1 :]
+    else:
+        head, releases = existing.rstrip("\n") + "\n\n", ""
+
+    # Drop a previously generated section for this version
+    own_heading = f"## [{version_string}]"
+    if releases.startswith(own_heading):
+        next_release = releases.find("\n## [")
+        releases = "" if next_release == -1 else releases[next_release + 1 :]
+
+    with open(changelog_path, "w") as f:
+        f.write(head + body + "\n" + releases)
+
+
+def _clean_item_markup(m: re.Match) -> str:
+    """Replacement callback for _ITEM_RE."""
+    if m.group(1) is not None:
+        # The scope group swallows any ** it contains, so strip them here
+        return f"({m.group(1).replace('**', '')}) "
+    if m.group(2) is not None:
+        return "[breaking] "
+    return ""
+
+
+def _parse_changelog_to_appstream(changelog_md: str) -> list[tuple[str, list[str]]]:
     """
-    Convert markdown changelog to AppStream XML format.
+    Parse a markdown changelog into AppStream description sections.
 
     Converts sections like:
     ### 🚀 Features
     - Add feature X
 
     To:
-    <p>Features:</p>
-    <ul>
-      <li>Add feature X</li>
-    </ul>
+    [("Features", ["Add feature X"])]
     """
-    lines = changelog_md.strip().split("\n")
-    xml_parts = []
+    lines = changelog_md.strip().splitlines()
+    sections = []
     current_section = None
     current_items = []
 
     def flush_section():
-        """Output the current section and items."""
+        """Record the current section and items."""
         if current_section and current_items:
             # Clean up section name (remove emojis and HTML comments)
             section_name = current_section
             # Remove HTML comments like <!-- 0 -->
-            section_name = re.sub(r"<!--\s*\d+\s*-->", "", section_name)
+            section_name = _COMMENT_RE.sub("", section_name)
             # Remove common emojis (but keep letters and numbers)
-            section_name = re.sub(r"[🚀🐛🚜📚⚡🎨🧪⚙️◀️💼]", "", section_name)
+            section_name = _EMOJI_RE.sub("", section_name)
             section_name = section_name.strip()
             if section_name:
-                xml_parts.append(f"        <p>{section_name}:</p>")
-                xml_parts.append("        <ul>")
-                for item in current_items:
-                    # Escape XML special characters
-                    item = (
-                        item.replace("&", "&amp;")
-                        .replace("<", "&lt;")
-                        .replace(">", "&gt;")
-                    )
-                    xml_parts.append(f"          <li>{item}</li>")
-                xml_parts.append("        </ul>")
+                sections.append((section_name, current_items))
 
     for line in lines:
         line = line.strip()
@@ -204,23 +288,14 @@ def _parse_changelog_to_appstream(changelog_md: str) -> str:
         # List item
         elif line.startswith("- "):
             item = line[2:].strip()
-            # Remove markdown formatting like *(scope)* and **breaking**
-            item = re.sub(r"\*\(([^)]+)\)\*\s*", r"(\1) ", item)
-            item = re.sub(
-                r"\[?\*\*breaking\*\*\]?\s*", "[breaking] ", item, flags=re.IGNORECASE
-            )
-            # Remove extra asterisks
-            item = item.replace("**", "")
-            current_items.append(item)
+            # Remove markdown formatting like *(scope)*, **breaking** and
+            # extra asterisks in a single pass
+            current_items.append(_ITEM_RE.sub(_clean_item_markup, item))
 
     # Flush the last section
     flush_section()
 
-    if xml_parts:
-        return "\n".join(xml_parts) + "\n"
-    else:
-        # Fallback if parsing fails
-        return "        <p>See CHANGELOG.md for details.</p>\n"
+    return sections
 
 
 if __name__ == "__main__":